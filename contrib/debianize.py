@@ -2,9 +2,13 @@
 #
 # Spits out a .deb file while avoiding all the Debian Project rigmarole.
 #
+import concurrent.futures
+import email.utils
+import functools
 import gzip
 import hashlib
 import io
+import mmap
 import os
 import re
 import shutil
@@ -13,6 +17,12 @@ import subprocess
 import sys
 import tempfile
 
+try:
+    # libdeflate bindings; optional
+    import deflate
+except ImportError:
+    deflate = None
+
 
 # configure me
 PACKAGE_NAME = "ripcalc"
@@ -38,95 +48,129 @@ LONG_DESCR = """It calculates subnets."""
 
 
 # constants
-READELF_MACHINE_RE = re.compile("(?m)^\\s+Machine:\\s+(\\S.*)$")
-VERSION_LINE_RE = re.compile("^\\s+(?:0+|0x[0-9a-f]+):\\s+Name: ([A-Z]+)_([0-9.]+)\\s+Flags: .+\\s+Version: .+$")
+VERSION_NAME_RE = re.compile("^([A-Z]+)_([0-9.]+)$", re.ASCII)
+SHT_GNU_VERNEED = 0x6FFFFFFE
+STRIP_CMD = ["strip", "--strip-unneeded", "-R", ".comment", "-R", ".note"]
+HASH_BLOCK_SIZE = 1024 * 1024
 
 
-def run_cmd(cmd_args, work_dir=None):
-    subproc = subprocess.Popen(
+def run_cmd(cmd_args, work_dir=None, env=None, input_bytes=None):
+    stdout = subprocess.check_output(
         cmd_args,
-        stdout=subprocess.PIPE,
         cwd=work_dir,
+        env=env,
+        input=input_bytes,
     )
-    (stdout, _stderr) = subproc.communicate()
-    result = subproc.wait()
-    if result != 0:
-        raise ValueError("{c} returned exit code {e}".format(c=cmd_args, e=result))
     return stdout.decode()
 
 
-def get_elf_machine(file_name):
-    with open(file_name, "rb") as f:
-        magic = f.read(4)
-        if magic != b"\x7FELF":
-            raise ValueError("ELF magic does not match")
+def decode_elf_ident(elf_bytes):
+    # https://en.wikipedia.org/wiki/Executable_and_Linkable_Format#File_header
+    if elf_bytes[0:4] != b"\x7FELF":
+        raise ValueError("ELF magic does not match")
 
-        bitness = f.read(1)
+    bitness = elf_bytes[4:5]
+    if bitness == b"\x01":
         bits = 32
-        if bitness == b"\x02":
-            bits = 64
-        else:
-            raise ValueError("invalid bitness: {b}".format(b=repr(bitness)))
-
-        endianness = f.read(1)
-
-        machine_struct = "<H"
-        if endianness == b"\x02":
-            machine_struct = ">H"
-        elif endianness != b"\x01":
-            raise ValueError("invalid endianness value: {ev}".format(ev=repr(endianness)))
+    elif bitness == b"\x02":
+        bits = 64
+    else:
+        raise ValueError("invalid bitness: {b}".format(b=repr(bitness)))
 
-        version = f.read(1)
-        if version != b"\x01":
-            raise ValueError("unsupported ELF version: {v}".format(v=repr(version)))
+    endianness = elf_bytes[5:6]
+    if endianness == b"\x01":
+        endian_char = "<"
+    elif endianness == b"\x02":
+        endian_char = ">"
+    else:
+        raise ValueError("invalid endianness value: {ev}".format(ev=repr(endianness)))
 
-        _abi = f.read(1)
-        _abi_ver = f.read(1)
-        _pad = f.read(7)
-        _file_type = f.read(2)
-        machine = f.read(2)
+    version = elf_bytes[6:7]
+    if version != b"\x01":
+        raise ValueError("unsupported ELF version: {v}".format(v=repr(version)))
 
-        # https://en.wikipedia.org/wiki/Executable_and_Linkable_Format#File_header
-        # https://www.debian.org/ports/
-        (machine_num,) = struct.unpack(machine_struct, machine)
-        return {
-            0x28: "armel",
-            0x3E: "amd64",
-            0xB7: "arm64",
-            0x03: "i386",
-            0x08: "mipsel" if bits == 32 else "mips64el",
-            0x15: "ppc64el",
-            0x16: "s390x",
-        }[machine_num]
+    return (bits, endian_char)
 
 
-def get_elf_versions(file_name, lib_to_ver):
-    elf_output = run_cmd(["readelf", "-V", file_name])
-    elf_lines = elf_output.strip().split("\n")
+def get_elf_machine(file_name):
+    with open(file_name, "rb") as f:
+        # identification, file type and machine
+        header = f.read(20)
 
-    correct_section = False
-    for ln in elf_lines:
-        if not ln.startswith(" "):
-            # section header
-            correct_section = ln.startswith("Version needs section '.gnu.version_r' contains ")
-            continue
+    (bits, endian_char) = decode_elf_ident(header)
 
-        if not correct_section:
-            # skip this section fully
-            continue
+    # https://www.debian.org/ports/
+    (machine_num,) = struct.unpack_from(endian_char + "H", header, 18)
+    return {
+        0x28: "armel",
+        0x3E: "amd64",
+        0xB7: "arm64",
+        0x03: "i386",
+        0x08: "mipsel" if bits == 32 else "mips64el",
+        0x15: "ppc64el",
+        0x16: "s390x",
+    }[machine_num]
 
-        # content line
-        m = VERSION_LINE_RE.match(ln)
-        if m is None:
-            continue
 
-        library = m.group(1)
-        ver_str = m.group(2)
-        ver = tuple(int(piece) for piece in ver_str.split("."))
+def get_elf_versions(file_name, lib_to_ver):
+    with open(file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as elf:
+        (bits, endian_char) = decode_elf_ident(elf)
+        if bits == 32:
+            header_struct = endian_char + "HHIIIIIHHHHHH"
+            section_header_struct = endian_char + "IIIIIIIIII"
+        else:
+            header_struct = endian_char + "HHIQQQIHHHHHH"
+            section_header_struct = endian_char + "IIQQQQIIQQ"
+        ver_struct = endian_char + "HHIII"
 
-        exist_ver = lib_to_ver.get(library, None)
-        if exist_ver is None or exist_ver < ver:
-            lib_to_ver[library] = ver
+        # https://en.wikipedia.org/wiki/Executable_and_Linkable_Format#File_header
+        header = struct.unpack_from(header_struct, elf, 16)
+        section_headers_offset = header[5]
+        section_header_size = header[10]
+        section_count = header[11]
+
+        # https://en.wikipedia.org/wiki/Executable_and_Linkable_Format#Section_header
+        section_headers = [
+            struct.unpack_from(section_header_struct, elf, section_headers_offset + i * section_header_size)
+            for i in range(section_count)
+        ]
+
+        for section_header in section_headers:
+            (_name, section_type, _flags, _addr, offset, _size, link, info, _align, _entsize) = section_header
+            if section_type != SHT_GNU_VERNEED:
+                continue
+
+            # the linked section contains the strings
+            (_, _, _, _, strings_offset, _, _, _, _, _) = section_headers[link]
+
+            # https://refspecs.linuxfoundation.org/LSB_5.0.0/LSB-Core-generic/LSB-Core-generic/symversion.html
+            # the section info field contains the number of Elfxx_Verneed entries
+            need_offset = offset
+            for _ in range(info):
+                (_version, aux_count, _file, aux_offset, next_need_offset) = struct.unpack_from(ver_struct, elf, need_offset)
+
+                # each has a list of Elfxx_Vernaux entries
+                vernaux_offset = need_offset + aux_offset
+                for _ in range(aux_count):
+                    (_hash, _flags, _other, name_offset, next_aux_offset) = struct.unpack_from(ver_struct, elf, vernaux_offset)
+                    name_start = strings_offset + name_offset
+                    name_end = elf.find(b"\x00", name_start)
+                    name = elf[name_start:name_end].decode("ascii")
+                    vernaux_offset += next_aux_offset
+
+                    m = VERSION_NAME_RE.match(name)
+                    if m is None:
+                        continue
+
+                    library = m.group(1)
+                    ver_str = m.group(2)
+                    ver = tuple(int(piece) for piece in ver_str.split("."))
+
+                    exist_ver = lib_to_ver.get(library, None)
+                    if exist_ver is None or exist_ver < ver:
+                        lib_to_ver[library] = ver
+
+                need_offset += next_need_offset
 
 
 def libver_to_deps(lib_to_ver):
@@ -143,13 +187,21 @@ def libver_to_deps(lib_to_ver):
     ]
 
 
+@functools.lru_cache(maxsize=1)
 def get_mail_date_time():
-    # does not work with older Python versions:
-    #return datetime.datetime.now().astimezone().strftime("%a, %d %b %Y %H:%M:%S %z")
-    return run_cmd(["date", "+%a, %d %b %Y %H:%M:%S %z"])
+    return email.utils.formatdate(localtime=True)
 
 
 def compress_gzip_without_timestamp(bytes_to_compress):
+    if deflate is not None:
+        gzip_bytes = bytearray(deflate.gzip_compress(bytes_to_compress, compresslevel=12))
+        # zero out the MTIME field of the gzip header
+        gzip_bytes[4:8] = b"\x00\x00\x00\x00"
+        return bytes(gzip_bytes)
+
+    if sys.version_info >= (3, 8):
+        return gzip.compress(bytes_to_compress, compresslevel=9, mtime=0)
+
     # older versions of Python do not have the mtime argument on gzip.compress()
     gzip_buffer = io.BytesIO()
     gzip_file = gzip.GzipFile(fileobj=gzip_buffer, mode="w", mtime=0)
@@ -158,6 +210,59 @@ def compress_gzip_without_timestamp(bytes_to_compress):
     return gzip_buffer.getvalue()
 
 
+def new_md5(data=b""):
+    # MD5 is only used for the md5sums file, not for security
+    try:
+        # Python 3.9+
+        return hashlib.md5(data, usedforsecurity=False)
+    except TypeError:
+        return hashlib.md5(data)
+
+
+def size_and_md5_file(file_name):
+    with open(file_name, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+
+            return (size, hashlib.file_digest(f, new_md5).hexdigest())
+
+        md5 = new_md5()
+        while True:
+            bs = f.read(HASH_BLOCK_SIZE)
+            if not bs:
+                break
+            md5.update(bs)
+        return (size, md5.hexdigest())
+
+
+def copy_and_md5_file(source_path, target_path):
+    # copy, measure and hash in one pass
+    md5 = new_md5()
+    size = 0
+    with open(source_path, "rb") as fi, open(target_path, "wb") as fo:
+        while True:
+            bs = fi.read(HASH_BLOCK_SIZE)
+            if not bs:
+                break
+            md5.update(bs)
+            fo.write(bs)
+            size += len(bs)
+    shutil.copymode(source_path, target_path)
+    return (size, md5.hexdigest())
+
+
+def install_file(source_path, target_path, strip):
+    if strip:
+        # strip while copying over, then hash the stripped result
+        run_cmd(STRIP_CMD + ["-o", target_path, source_path])
+        shutil.copymode(source_path, target_path)
+        return size_and_md5_file(target_path)
+
+    # copy over!
+    return copy_and_md5_file(source_path, target_path)
+
+
 def fake_changelog(code_revision):
     changelog_fmt = """
 {pn} ({cr}) unstable; urgency=medium
@@ -199,30 +304,68 @@ License: {li}
     return copyright_bytes
 
 
+def make_tarball(source_dir, archive_path, compress_flag, env=None):
+    # list the entries ourselves in a fixed order
+    # (tar would otherwise walk the directory in readdir order;
+    # --sort=name is too new for the tar on the older CI images)
+    rel_paths = ["."]
+    for dir_path, dir_names, file_names in os.walk(source_dir):
+        for name in dir_names + file_names:
+            rel_path = os.path.relpath(os.path.join(dir_path, name), source_dir)
+            rel_paths.append(os.path.join(".", rel_path))
+    rel_paths.sort()
+    rel_paths_bytes = "".join(
+        "{p}\n".format(p=rel_path)
+        for rel_path in rel_paths
+    ).encode("utf-8")
+
+    run_cmd(
+        [
+            "tar",
+            "-c",
+            compress_flag,
+            "-f", archive_path,
+            "--owner=root:0",
+            "--group=root:0",
+            "--mtime=@0",
+            "--no-recursion",
+            "-T", "-",
+        ],
+        work_dir=source_dir,
+        env=env,
+        input_bytes=rel_paths_bytes,
+    )
+
+
 def collect_data(temp_dir, code_dir, generated_files):
     # directory to assemble data files
     data_dir = os.path.join(temp_dir, "data")
     os.mkdir(data_dir)
 
-    # copy over the files
+    # ensure the subdirectories exist
+    # (up front, so that the workers do not race to create them)
+    for target_rel_path in FILES.values():
+        target_dir = os.path.dirname(os.path.join(data_dir, target_rel_path))
+        os.makedirs(target_dir, exist_ok=True)
+
+    # copy over the files in parallel, noting their sizes and MD5 checksums
+    target_rel_path_to_size_and_md5 = {}
     source_and_target_paths = sorted(
         FILES.items(),
         key=lambda st: (st[1], st[0]),
     )
-    for source_rel_path, target_rel_path in source_and_target_paths:
-        source_path = os.path.join(code_dir, source_rel_path)
-        target_path = os.path.join(data_dir, target_rel_path)
-
-        # ensure the subdirectory exists
-        target_dir = os.path.dirname(target_path)
-        os.makedirs(target_dir, exist_ok=True)
-
-        # copy over!
-        shutil.copy(source_path, target_path)
-
-        if target_rel_path in STRIP_TARGET_FILES:
-            # also strip the file
-            run_cmd(["strip", target_path])
+    max_workers = max(1, min(8, len(source_and_target_paths)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        target_rel_path_to_future = {}
+        for source_rel_path, target_rel_path in source_and_target_paths:
+            target_rel_path_to_future[target_rel_path] = executor.submit(
+                install_file,
+                os.path.join(code_dir, source_rel_path),
+                os.path.join(data_dir, target_rel_path),
+                target_rel_path in STRIP_TARGET_FILES,
+            )
+        for target_rel_path, future in target_rel_path_to_future.items():
+            target_rel_path_to_size_and_md5[target_rel_path] = future.result()
 
     # also the autogenerated files
     for target_rel_path, bs in generated_files.items():
@@ -231,50 +374,40 @@ def collect_data(temp_dir, code_dir, generated_files):
         target_dir = os.path.dirname(target_path)
         os.makedirs(target_dir, exist_ok=True)
 
-        with open(target_path, "wb") as f:
-            f.write(bs)
+        # small and already in memory; skip the buffered file object
+        fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            written = 0
+            while written < len(bs):
+                written += os.write(fd, bs[written:])
+        finally:
+            os.close(fd)
 
         if target_rel_path in STRIP_TARGET_FILES:
             # also strip the file
-            run_cmd(["strip", target_path])
+            run_cmd(STRIP_CMD + [target_path])
+            size_and_md5 = size_and_md5_file(target_path)
+        else:
+            size_and_md5 = (len(bs), new_md5(bs).hexdigest())
+        target_rel_path_to_size_and_md5[target_rel_path] = size_and_md5
 
     # tar up the data archive
-    run_cmd(
-        [
-            "tar",
-            "-cJ",
-            "-f", "../data.tar.xz",
-            "--owner=root:0",
-            "--group=root:0",
-            ".",
-        ],
-        work_dir=data_dir,
-    )
+    # (let xz compress using all cores unless the user has their own opinion)
+    xz_env = dict(os.environ)
+    xz_env.setdefault("XZ_OPT", "-T0")
+    make_tarball(data_dir, "../data.tar.xz", "-J", env=xz_env)
 
-    # return the data directory path for further processing
-    return data_dir
+    # return the data directory path and file info for further processing
+    return (data_dir, target_rel_path_to_size_and_md5)
 
 
-def collect_control(temp_dir, data_dir, generated_files, code_revision, deb_arch):
-    # calculate the total size and MD5 checksum of all the files
+def collect_control(temp_dir, data_dir, target_rel_path_to_size_and_md5, code_revision, deb_arch):
+    # sum up the total size and pick out the MD5 checksums of all the files
     target_rel_path_to_md5 = {}
     total_size_bytes = 0
-    for target_rel_path in FILES.values():
-        target_path = os.path.join(data_dir, target_rel_path)
-        total_size_bytes += os.stat(target_path).st_size
-
-        md5 = hashlib.md5()
-        with open(target_path, "rb") as f:
-            while True:
-                bs = f.read(1024)
-                if not bs:
-                    break
-                md5.update(bs)
-        target_rel_path_to_md5[target_rel_path] = md5.hexdigest()
-
-    for target_rel_path, bs in generated_files.items():
-        total_size_bytes += len(bs)
-        target_rel_path_to_md5[target_rel_path] = hashlib.md5(bs).hexdigest()
+    for target_rel_path, (size, md5) in target_rel_path_to_size_and_md5.items():
+        total_size_bytes += size
+        target_rel_path_to_md5[target_rel_path] = md5
 
     total_size_kib = total_size_bytes // 1024
 
@@ -330,26 +463,41 @@ Description: {sd}
         f.write(control_file_contents.encode("utf-8"))
 
     # the md5sums file
-    with open(os.path.join(temp_dir, "control", "md5sums"), "w", encoding="utf-8") as f:
+    with open(os.path.join(temp_dir, "control", "md5sums"), "w", encoding="utf-8", newline="") as f:
         target_paths_and_md5s = sorted(
             target_rel_path_to_md5.items(),
             key=lambda tm: (tm[1], tm[0]),
         )
-        for target_path, md5 in target_paths_and_md5s:
-            f.write("{m}  {p}\n".format(m=md5, p=target_path))
+        f.write("".join(
+            "{m}  {p}\n".format(m=md5, p=target_path)
+            for target_path, md5 in target_paths_and_md5s
+        ))
 
     # tar up the control archive
-    run_cmd(
-        [
-            "tar",
-            "-cz",
-            "-f", "../control.tar.gz",
-            "--owner=root:0",
-            "--group=root:0",
-            ".",
-        ],
-        work_dir=control_dir,
-    )
+    make_tarball(control_dir, "../control.tar.gz", "-z")
+
+
+def write_ar(ar_path, member_paths):
+    # equivalent to "ar rcD": GNU-style names, zero timestamps and IDs, mode 644
+    with open(ar_path, "wb") as fo:
+        fo.write(b"!<arch>\n")
+        for member_path in member_paths:
+            member_name = os.path.basename(member_path)
+            member_size = os.stat(member_path).st_size
+            member_header = "{n:<16}{t:<12}{u:<6}{g:<6}{m:<8}{s:<10}`\n".format(
+                n=member_name + "/",
+                t=0,
+                u=0,
+                g=0,
+                m="644",
+                s=member_size,
+            )
+            fo.write(member_header.encode("ascii"))
+            with open(member_path, "rb") as fi:
+                shutil.copyfileobj(fi, fo, HASH_BLOCK_SIZE)
+            if member_size % 2 != 0:
+                # members are aligned to an even offset
+                fo.write(b"\n")
 
 
 def main():
@@ -359,7 +507,10 @@ def main():
     code_dir = os.path.dirname(script_dir)
 
     # what version do we have?
-    code_revision = run_cmd(["git", "rev-list", "--count", "HEAD"], code_dir).rstrip("\n")
+    # (CI may already know and pass it in)
+    code_revision = os.environ.get("DEBIANIZE_REV", None)
+    if not code_revision:
+        code_revision = run_cmd(["git", "rev-list", "--count", "HEAD"], code_dir).rstrip("\n")
 
     # fake a changelog, make a copyright
     changelog_gz_bytes = fake_changelog(code_revision)
@@ -385,10 +536,10 @@ def main():
             f.write(b"2.0\n")
 
         # collect the data
-        data_dir = collect_data(temp_dir, code_dir, generated_files)
+        (data_dir, target_rel_path_to_size_and_md5) = collect_data(temp_dir, code_dir, generated_files)
 
         # collect the control files
-        collect_control(temp_dir, data_dir, generated_files, code_revision, deb_arch)
+        collect_control(temp_dir, data_dir, target_rel_path_to_size_and_md5, code_revision, deb_arch)
 
         deb_name = "{pn}_{cr}_{da}.deb".format(
             pn=PACKAGE_NAME,
@@ -398,21 +549,18 @@ def main():
         deb_path = os.path.join(temp_dir, deb_name)
 
         # ar the whole thing
-        run_cmd(
+        write_ar(
+            deb_path,
             [
-                "ar",
-                "rcD",
-                deb_name,
-                "debian-binary",
-                "control.tar.gz",
-                "data.tar.xz",
+                os.path.join(temp_dir, "debian-binary"),
+                os.path.join(temp_dir, "control.tar.gz"),
+                os.path.join(temp_dir, "data.tar.xz"),
             ],
-            work_dir=temp_dir,
         )
 
         # copy the archive out
         deb_target_name = os.path.join(code_dir, deb_name)
-        shutil.copy(deb_path, deb_target_name)
+        shutil.copyfile(deb_path, deb_target_name)
 
         # print out the name
         print(deb_name)